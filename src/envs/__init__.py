@@ -22,8 +22,11 @@ def build_env(params):
     """
     env = ENVS[params.env_name](params)
 
-    # tasks
-    tasks = [x for x in params.tasks.split(",") if len(x) > 0]
+    # tasks (comma separated string, parsed once into a tuple of task names)
+    tasks = params.tasks
+    if isinstance(tasks, str):
+        tasks = [x for x in tasks.split(",") if len(x) > 0]
+    tasks = tuple(tasks)
     assert len(tasks) == len(set(tasks)) > 0
     assert all(task in env.TRAINING_TASKS for task in tasks)
     params.tasks = tasks
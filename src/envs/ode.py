@@ -11,6 +11,7 @@ import io
 import sys
 from typing import List, Optional, Tuple
 from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
 import torch
 from torch.utils.data.dataset import Dataset
@@ -77,6 +78,18 @@ def has_inf_nan(*args):
     return False
 
 
+@lru_cache(maxsize=None)
+def exp_decay_weights(n, rate):
+    """
+    Normalized weights proportional to exp(-rate * i), for i in {0, ..., n - 1}.
+    The array is cached and shared, hence read-only.
+    """
+    weights = np.array([np.exp(-rate * i) for i in range(n)])
+    weights = weights / np.sum(weights)
+    weights.flags.writeable = False
+    return weights
+
+
 def last_index(x, bal):
     try:
         p1 = x[::-1].index(bal)
@@ -109,27 +122,27 @@ def simplify(f, seconds):
     return _simplify(f)
 
 
-def expr_to_fun(x, f, point):
+def expr_to_fun(f, n_vars):
     """
     Transforms a sympy expression into a callable function that returns a float for optimization.
-    To be deprecated in the future using sympy lambdify that is much faster
+    The expression is compiled once with sympy lambdify, instead of being substituted / evaluated at each call.
     """
-    for i in range(len(point)):
-        v = "x" + str(i)
-        f = f.subs(v, x[i])
-    f = f.evalf()
-    f = min(f, 1e20)
-    f = max(f, -1e20)
-    f = float(f)
-    return f
+    f_num = sp.lambdify(sp.symbols(f"x0:{n_vars}"), f, "numpy")
+
+    def fun(x):
+        # overflows are clipped and underflows flushed to 0, as with the former symbolic evaluation
+        with np.errstate(over="ignore", under="ignore"):
+            return float(np.clip(f_num(*x), -1e20, 1e20))
+
+    return fun
 
 
 def test_V_positive(V, point, domain: Optional[List["Node"]] = None, debug=False):
     """
     Take an object, a sympy expression, and a point and test the positivity of V.
-    To be deprecated in the future using sympy lambdify that is much faster
     """
     n_vars = len(point)
+    V_fun = expr_to_fun(V, n_vars)
     # Compute the gradient for the minimization
     x = sp.symbols(f"x0:{n_vars}")
     grad_V = [sp.diff(V, x[i]) for i in range(n_vars)]
@@ -147,9 +160,8 @@ def test_V_positive(V, point, domain: Optional[List["Node"]] = None, debug=False
         for _ in range(len(point)):
             bounds.append((-10, 10))
         y = opt.shgo(
-            expr_to_fun,
+            V_fun,
             bounds,
-            args=(V, point),
             sampling_method="simplicial",
             minimizer_kwargs={"options": {"maxiter": 3000, "disp": False}, "jac": grad_V_fun},
         )
@@ -171,12 +183,12 @@ def test_V_positive(V, point, domain: Optional[List["Node"]] = None, debug=False
                 assert el_dom.children[1].eq(Node(0)), el_dom
                 new_cons = f"1/({el_dom.children[0].infix()})"
                 cons_sympy_neq.append(sp.S(new_cons))
-                constraint_tab_neq.append(lambda x: expr_to_fun(x, cons_sympy_neq[-1], point))
+                constraint_tab_neq.append(expr_to_fun(cons_sympy_neq[-1], n_vars))
             else:
                 assert el_dom.children[0].eq(Node(0)), el_dom
                 new_cons = el_dom.children[1].infix()
                 cons_sympy.append(sp.S(new_cons))
-                constraint_tab.append(lambda x: expr_to_fun(x, cons_sympy[-1], point))
+                constraint_tab.append(expr_to_fun(cons_sympy[-1], n_vars))
         constraints = [opt.NonlinearConstraint(ci, 0, np.inf) for ci in constraint_tab]
         constraints.extend([opt.NonlinearConstraint(ci, -1e20, 1e20) for ci in constraint_tab_neq])
         if debug:
@@ -187,9 +199,8 @@ def test_V_positive(V, point, domain: Optional[List["Node"]] = None, debug=False
         for _ in range(len(point)):
             bounds.append((-10, 10))
         y = opt.shgo(
-            expr_to_fun,
+            V_fun,
             bounds,
-            args=(V, point),
             minimizer_kwargs={"constraints": constraints, "options": {"maxiter": 3000, "disp": False}, "jac": grad_V_fun},
         )
 
@@ -749,6 +760,8 @@ class ODEEnvironment(object):
 
         # initialize distribution for binary and unary-binary trees
         self.distrib = self.generate_dist(2 * self.max_ops)
+        # next node position / arity probabilities, filled lazily by next_pos_probs
+        self.next_pos_cache = {}
 
     def get_integer(self, positive=False, max_int: Optional[int] = None):
         """
@@ -817,13 +830,13 @@ class ODEEnvironment(object):
         assert all(len(D[i]) >= len(D[i + 1]) for i in range(len(D) - 1))
         return D
 
-    def sample_next_pos(self, nb_empty, nb_ops):
+    def next_pos_probs(self, nb_empty, nb_ops):
         """
-        Sample the position of the next node (binary case).
-        Sample a position in {0, ..., `nb_empty` - 1}.
+        Probabilities of the position / arity of the next node, given the number of empty nodes and operators left.
+        Only depends on the tree counts in `self.distrib`, and is cached in `self.next_pos_cache` (read-only arrays).
         """
-        assert nb_empty > 0
-        assert nb_ops > 0
+        if (nb_empty, nb_ops) in self.next_pos_cache:
+            return self.next_pos_cache[(nb_empty, nb_ops)]
         probs = []
         if self.unary:
             for i in range(nb_empty):
@@ -832,6 +845,18 @@ class ODEEnvironment(object):
             probs.append(self.distrib[nb_ops - 1][nb_empty - i + 1])
         probs = [p / self.distrib[nb_ops][nb_empty] for p in probs]
         probs = np.array(probs, dtype=np.float64)
+        probs.flags.writeable = False
+        self.next_pos_cache[(nb_empty, nb_ops)] = probs
+        return probs
+
+    def sample_next_pos(self, nb_empty, nb_ops):
+        """
+        Sample the position of the next node (binary case).
+        Sample a position in {0, ..., `nb_empty` - 1}.
+        """
+        assert nb_empty > 0
+        assert nb_ops > 0
+        probs = self.next_pos_probs(nb_empty, nb_ops)
         e = self.rng.choice(len(probs), p=probs)
         arity = 1 if self.unary and e < nb_empty else 2
         e %= nb_empty
@@ -1922,16 +1947,14 @@ class ODEEnvironment(object):
             nb_components = degree
         else:
             if self.lyap_gen_weight > 0:
-                weights = np.array([np.exp(-self.lyap_gen_weight * i) for i in range(degree)])
-                weights = weights / np.sum(weights)
+                weights = exp_decay_weights(degree, self.lyap_gen_weight)
                 nb_components = self.rng.choice(range(1, degree + 1), p=weights)
             else:
                 nb_components = self.rng.randint(1, degree + 1)
 
         # Number of vectors to be used
         if self.lyap_gen_weight > 0:
-            weights = np.array([np.exp(-self.lyap_gen_weight * i) for i in range(degree)])
-            weights = weights / np.sum(weights)
+            weights = exp_decay_weights(degree, self.lyap_gen_weight)
             nb_vectors = self.rng.choice(range(degree), p=weights)
         else:
             nb_vectors = self.rng.randint(degree)
@@ -2352,13 +2375,17 @@ class ODEEnvironment(object):
         logger.info(f"Creating train iterator for {task} ...")
 
         dataset = EnvDataset(self, task, train=True, params=params, path=(None if data_path is None else data_path[task][0]))
+        num_workers = params.num_workers if data_path is None or params.num_workers == 0 else 1
         return DataLoader(
             dataset,
             timeout=(0 if params.num_workers == 0 else 86400),
             batch_size=params.batch_size,
-            num_workers=(params.num_workers if data_path is None or params.num_workers == 0 else 1),
+            num_workers=num_workers,
             shuffle=False,
             collate_fn=dataset.collate_fn,
+            pin_memory=not params.cpu,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=(4 if num_workers > 0 else None),
         )
 
     def create_test_iterator(self, data_type, task, data_path, data_path_idx, batch_size, params, size):
@@ -2371,7 +2398,9 @@ class ODEEnvironment(object):
         logger.info(f"Creating {data_type} iterator for {task} ...")
 
         dataset = EnvDataset(self, task, train=False, params=params, path=(None if data_path is None else data_path[task][data_path_idx]), size=size)
-        return DataLoader(dataset, timeout=0, batch_size=batch_size, num_workers=1, shuffle=True, collate_fn=dataset.collate_fn)
+        return DataLoader(
+            dataset, timeout=0, batch_size=batch_size, num_workers=1, shuffle=True, collate_fn=dataset.collate_fn, pin_memory=not params.cpu
+        )
 
     @staticmethod
     def register_args(parser):
@@ -2662,7 +2691,9 @@ class EnvDataset(Dataset):
         """
         self.init_rng()
         if self.path is None:
-            return self.generate_sample()
+            # floating point errors (e.g. diverging systems) raise, and the sample is discarded
+            with np.errstate(all="raise"):
+                return self.generate_sample()
         else:
             return self.read_sample(index)
 
@@ -54,7 +54,8 @@ def check_hypothesis(eq):
     hyp = [env.id2word[wid] for wid in eq["hyp"]]
 
     try:
-        is_valid = env.check_lyap_validity(src, hyp, tgt)
+        with np.errstate(all="raise"):
+            is_valid = env.check_lyap_validity(src, hyp, tgt)
     except MyTimeoutError:
         is_valid = -3
     except Exception as e:
@@ -96,7 +97,8 @@ class Evaluator(object):
             scores["unique_prop"] = 100.0 * scores["unique"] / scores["total"]
             return scores
 
-        with torch.no_grad():
+        amp = torch.autocast(device_type="cuda", dtype=self.trainer.amp_dtype, enabled=self.trainer.amp_enabled)
+        with torch.inference_mode(), amp:
             for task in params.tasks:
                 eval_tasks = [["valid", 1]]
                 for idx in range(2, len(self.trainer.data_path[task])):
@@ -8,6 +8,7 @@
 from logging import getLogger
 import os
 import torch
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 
 from .transformer import TransformerModel
 
@@ -22,6 +23,9 @@ def check_model_params(params):
     # model dimensions
     assert params.emb_dim % params.n_heads == 0
 
+    # torch.compile mode (only used with --compile true)
+    assert params.compile or params.compile_mode == "default", "--compile_mode requires --compile true"
+
     # reload a pretrained model
     if params.reload_model != "":
         assert os.path.isfile(params.reload_model)
@@ -56,4 +60,21 @@ def build_modules(env, params):
         for v in modules.values():
             v.cuda()
 
+    # distributed (one process / model replica per GPU)
+    if params.multi_gpu:
+        logger.info("Using nn.parallel.DistributedDataParallel ...")
+        for k in modules.keys():
+            modules[k] = torch.nn.parallel.DistributedDataParallel(
+                modules[k],
+                device_ids=[params.local_rank],
+                output_device=params.local_rank,
+                broadcast_buffers=False,
+                gradient_as_bucket_view=True,
+                find_unused_parameters=False,
+                static_graph=True,
+            )
+            # all-reduce gradients in bf16, halving the communication volume
+            if params.amp == "bf16":
+                modules[k].register_comm_hook(state=None, hook=default_hooks.bf16_compress_hook)
+
     return modules
@@ -36,9 +36,10 @@ def create_sinusoidal_embeddings(n_pos, dim, out):
     out.requires_grad = False
 
 
-def get_masks(slen, lengths, causal):
+def get_masks(slen, lengths, causal, causal_mask=None):
     """
     Generate hidden states mask, and optionally an attention mask.
+    `causal_mask` is an optional precomputed triangular inferior mask, of size at least (slen, slen).
     """
     assert lengths.max().item() <= slen
     bs = lengths.size(0)
@@ -46,7 +47,9 @@ def get_masks(slen, lengths, causal):
     mask = alen < lengths[:, None]
 
     # attention mask is the same as mask, or triangular inferior attention (causal)
-    if causal:
+    if causal and causal_mask is not None and slen <= causal_mask.size(0):
+        attn_mask = causal_mask[:slen, :slen][None].expand(bs, slen, slen)
+    elif causal:
         attn_mask = alen[None, None, :].repeat(bs, slen, 1) <= alen[None, :, None]
     else:
         attn_mask = mask
@@ -122,7 +125,7 @@ class MultiHeadAttention(nn.Module):
         q = q / math.sqrt(dim_per_head)  # (bs, n_heads, qlen, dim_per_head)
         scores = torch.matmul(q, k.transpose(2, 3))  # (bs, n_heads, qlen, klen)
         mask = (mask == 0).view(mask_reshape).expand_as(scores)  # (bs, n_heads, qlen, klen)
-        scores.masked_fill_(mask, -float("inf"))  # (bs, n_heads, qlen, klen)
+        scores.masked_fill_(mask, torch.finfo(scores.dtype).min)  # (bs, n_heads, qlen, klen)
 
         weights = F.softmax(scores.float(), dim=-1).type_as(scores)  # (bs, n_heads, qlen, klen)
         weights = F.dropout(weights, p=self.dropout, training=self.training)  # (bs, n_heads, qlen, klen)
@@ -162,7 +165,7 @@ class TransformerModel(nn.Module):
         super().__init__()
 
         # encoder / decoder, output layer
-        self.dtype = torch.half if params.fp16 else torch.float
+        self.dtype = {"fp16": torch.half, "bf16": torch.bfloat16}.get(params.amp, torch.float)
         self.is_encoder = is_encoder
         self.is_decoder = not is_encoder
         self.with_output = with_output
@@ -212,6 +215,11 @@ class TransformerModel(nn.Module):
 
         self.cache = None
 
+        # causal attention mask, computed once (not saved in checkpoints)
+        if self.is_decoder:
+            causal_len = max(params.max_len, params.max_output_len + 2)
+            self.register_buffer("causal_mask", torch.ones(causal_len, causal_len, dtype=torch.bool).tril(), persistent=False)
+
         # output layer
         if self.with_output:
             self.proj = nn.Linear(self.dim, params.n_words, bias=True)
@@ -253,7 +261,7 @@ class TransformerModel(nn.Module):
         assert not (use_cache and self.cache is None)
 
         # generate masks
-        mask, attn_mask = get_masks(slen, lengths, causal)
+        mask, attn_mask = get_masks(slen, lengths, causal, causal_mask=(self.causal_mask if self.is_decoder else None))
         if self.is_decoder and src_enc is not None:
             if self.max_src_len > 0:
                 src_mask = torch.arange(src_len.max(), dtype=torch.long, device=lengths.device) < torch.clamp(src_len[:, None], max=self.max_src_len)
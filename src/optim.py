@@ -45,43 +45,47 @@ class Adam(optim.Optimizer):
     def step(self, closure=None):
         """
         Step.
+        Parameters of a group are updated together with multi-tensor (foreach) kernels.
         """
         loss = None
         if closure is not None:
             loss = closure()
 
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
-
-                state = self.state[p]
-
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-                beta1, beta2 = group["betas"]
-
+            with_grad = [p for p in group["params"] if p.grad is not None]
+            if len(with_grad) == 0:
+                continue
+            if any(p.grad.is_sparse for p in with_grad):
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+
+            states = [self.state[p] for p in with_grad]
+            grads = [p.grad.data for p in with_grad]
+            exp_avgs = [state["exp_avg"] for state in states]
+            exp_avg_sqs = [state["exp_avg_sq"] for state in states]
+            params = [p.data for p in with_grad]
+            beta1, beta2 = group["betas"]
+
+            for state in states:
                 state["step"] += 1
 
-                # if group['weight_decay'] != 0:
-                #     grad.add_(group['weight_decay'], p.data)
-
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                denom = exp_avg_sq.sqrt().add_(group["eps"])
-                # denom = exp_avg_sq.sqrt().clamp_(min=group['eps'])
+            # Decay the first and second moment running average coefficient
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denoms, group["eps"])
 
-                bias_correction1 = 1 - beta1 ** state["step"]  # .item()
-                bias_correction2 = 1 - beta2 ** state["step"]  # .item()
-                step_size = group["lr"] * math.sqrt(bias_correction2) / bias_correction1
+            step_sizes = []
+            for state in states:
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                step_sizes.append(-group["lr"] * math.sqrt(bias_correction2) / bias_correction1)
 
-                if group["weight_decay"] != 0:
-                    p.data.add_(-group["weight_decay"] * group["lr"], p.data)
+            if group["weight_decay"] != 0:
+                torch._foreach_mul_(params, 1 - group["weight_decay"] * group["lr"])
 
-                p.data.addcdiv_(-step_size, exp_avg, denom)
+            torch._foreach_addcdiv_(params, exp_avgs, denoms, step_sizes)
 
         return loss
 
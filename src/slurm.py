@@ -108,15 +108,16 @@ def init_distributed_mode(params):
         os.environ["WORLD_SIZE"] = str(params.world_size)
         os.environ["RANK"] = str(params.global_rank)
 
-    # multi-GPU job (local or multi-node) - jobs started with torch.distributed.launch
-    elif params.local_rank != -1:
+    # multi-GPU job (local or multi-node) - jobs started with torchrun / torch.distributed.launch
+    elif params.local_rank != -1 or "LOCAL_RANK" in os.environ:
 
         assert params.master_port == -1
 
-        # read environment variables
+        # read environment variables (torchrun does not pass --local_rank)
+        params.local_rank = int(os.environ.get("LOCAL_RANK", params.local_rank))
         params.global_rank = int(os.environ["RANK"])
         params.world_size = int(os.environ["WORLD_SIZE"])
-        params.n_gpu_per_node = int(os.environ["NGPU"])
+        params.n_gpu_per_node = int(os.environ.get("NGPU", os.environ.get("LOCAL_WORLD_SIZE")))
 
         # number of nodes / node ID
         params.n_nodes = params.world_size // params.n_gpu_per_node
@@ -11,6 +11,7 @@ import sys
 import time
 from logging import getLogger
 from collections import OrderedDict
+from contextlib import ExitStack
 import numpy as np
 import torch
 from torch import nn
@@ -24,6 +25,53 @@ from .utils import to_cuda
 logger = getLogger()
 
 
+def get_data_path(env, params):
+    """
+    Parse `params.reload_data` into a dictionary task -> (train, valid, test...) paths.
+    """
+    if params.reload_data == "":
+        return None
+    s = [x.split(",") for x in params.reload_data.split(";") if len(x) > 0]
+    assert len(s) >= 1 and len(s) == len(set([x[0] for x in s]))
+    data_path = {el[0]: tuple(el[1:]) for el in s}
+    assert all(all(os.path.isfile(path) for path in paths) for paths in data_path.values())
+    for task in env.TRAINING_TASKS:
+        assert (task in data_path) == (task in params.tasks)
+    return data_path
+
+
+def get_amp(params):
+    """
+    Native AMP settings: autocast dtype, and whether autocast is enabled.
+    """
+    amp_dtype = {"off": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[params.amp]
+    amp_enabled = params.amp != "off" and not params.cpu
+    return amp_dtype, amp_enabled
+
+
+def reload_checkpoint_modules(modules, params, epoch_size):
+    """
+    Reload the model parameters of a checkpoint if we find one (in the dump path, or `params.reload_checkpoint`).
+    Return the checkpoint data and the epoch to resume (checkpoints saved within an epoch resume that epoch), None if there is none.
+    """
+    checkpoint_path = os.path.join(params.dump_path, "checkpoint.pth")
+    if not os.path.isfile(checkpoint_path):
+        if params.reload_checkpoint == "":
+            return None
+        else:
+            checkpoint_path = params.reload_checkpoint
+            assert os.path.isfile(checkpoint_path)
+    logger.warning(f"Reloading checkpoint from {checkpoint_path} ...")
+    data = torch.load(checkpoint_path, map_location="cpu")
+
+    # reload model parameters
+    for k, v in modules.items():
+        getattr(v, "_orig_mod", v).load_state_dict(data[k])
+
+    epoch = data["epoch"] if 0 < data.get("n_equations", 0) < epoch_size else data["epoch"] + 1
+    return data, epoch
+
+
 class Trainer(object):
 
     EQUATIONS = {}
@@ -49,23 +97,16 @@ class Trainer(object):
         # set parameters
         self.set_parameters()
 
-        # float16 / distributed (no AMP)
-        assert params.amp >= 1 or not params.fp16
-        assert params.amp >= 0 or params.accumulate_gradients == 1
-        if params.multi_gpu:
-            logger.info("Using nn.parallel.DistributedDataParallel ...")
-            for k in self.modules.keys():
-                self.modules[k] = nn.parallel.DistributedDataParallel(
-                    self.modules[k], device_ids=[params.local_rank], output_device=params.local_rank, broadcast_buffers=True
-                )
+        # distributed (modules are wrapped in DistributedDataParallel by build_modules, then possibly compiled)
+        assert not params.multi_gpu or all(
+            isinstance(getattr(v, "_orig_mod", v), nn.parallel.DistributedDataParallel) for v in self.modules.values()
+        )
 
         # set optimizer
         self.set_optimizer()
 
-        # float16 / distributed (AMP)
-        self.scaler = None
-        if params.amp >= 0:
-            self.init_amp()
+        # float16 / bfloat16 (native AMP)
+        self.init_amp()
 
         # stopping criterion used for early stopping
         if params.stopping_criterion != "":
@@ -94,6 +135,8 @@ class Trainer(object):
         self.epoch = 0
         self.n_iter = 0
         self.n_total_iter = 0
+        self.n_equations = 0
+        self.accum_step = 0
         self.stats = OrderedDict(
             [("processed_e", 0)] + [("processed_w", 0)] + sum([[(x, []), (f"{x}-AVG-STOP-PROBS", [])] for x in env.TRAINING_TASKS], [])
         )
@@ -113,14 +156,7 @@ class Trainer(object):
         if params.reload_data != "":
             assert params.num_workers in [0, 1]
             assert params.export_data is False
-            s = [x.split(",") for x in params.reload_data.split(";") if len(x) > 0]
-            assert len(s) >= 1 and len(s) == len(set([x[0] for x in s]))
-            self.data_path = {el[0]: tuple(el[1:]) for el in s}
-            assert all(all(os.path.isfile(path) for path in paths) for paths in self.data_path.values())
-            for task in self.env.TRAINING_TASKS:
-                assert (task in self.data_path) == (task in params.tasks)
-        else:
-            self.data_path = None
+        self.data_path = get_data_path(env, params)
 
         # create data loaders
         if not params.eval_only:
@@ -151,13 +187,22 @@ class Trainer(object):
 
     def init_amp(self):
         """
-        Initialize AMP optimizer.
+        Initialize native AMP (autocast dtype / gradient scaler).
+        The gradient scaler is only needed for float16, bfloat16 has the float32 range.
         """
-        params = self.params
-        assert params.amp == 0 and params.fp16 is False or params.amp in [1, 2, 3] and params.fp16 is True
-        mod_names = sorted(self.modules.keys())
-        mod_names = sorted(self.modules.keys())
-        self.scaler = torch.cuda.amp.GradScaler()
+        self.amp_dtype, self.amp_enabled = get_amp(self.params)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp_enabled and self.amp_dtype == torch.float16)
+
+    def grad_sync_context(self):
+        """
+        Context manager disabling the DDP gradient all-reduce during gradient accumulation.
+        Gradients are only synchronized on the last micro-batch of each accumulation window.
+        """
+        stack = ExitStack()
+        if self.params.multi_gpu and self.accum_step % self.params.accumulate_gradients != 0:
+            for module in self.modules.values():
+                stack.enter_context(module.no_sync())
+        return stack
 
     def optimize(self, loss):
         """
@@ -173,27 +218,19 @@ class Trainer(object):
         # optimizer
         optimizer = self.optimizer
 
-        # regular optimization
-        if params.amp == -1:
-            optimizer.zero_grad()
-            loss.backward()
+        # backward (the scaler is a no-op when disabled)
+        if params.accumulate_gradients > 1:
+            loss = loss / params.accumulate_gradients
+        self.scaler.scale(loss).backward()
+
+        # update
+        if self.accum_step % params.accumulate_gradients == 0:
             if params.clip_grad_norm > 0:
+                self.scaler.unscale_(optimizer)
                 clip_grad_norm_(self.parameters["model"], params.clip_grad_norm)
-            optimizer.step()
-
-        # AMP optimization
-        else:
-            if params.accumulate_gradients > 1:
-                loss = loss / params.accumulate_gradients
-            self.scaler.scale(loss).backward()
-
-            if (self.n_iter + 1) % params.accumulate_gradients == 0:
-                if params.clip_grad_norm > 0:
-                    self.scaler.unscale_(optimizer)
-                    clip_grad_norm_(self.parameters["model"], params.clip_grad_norm)
-                self.scaler.step(optimizer)
-                self.scaler.update()
-                optimizer.zero_grad()
+            self.scaler.step(optimizer)
+            self.scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
     def iter(self):
         """
@@ -245,6 +282,7 @@ class Trainer(object):
         data = {
             "epoch": self.epoch,
             "n_total_iter": self.n_total_iter,
+            "n_equations": self.n_equations,
             "best_metrics": self.best_metrics,
             "best_stopping_criterion": self.best_stopping_criterion,
             "params": {k: v for k, v in self.params.__dict__.items()},
@@ -252,12 +290,12 @@ class Trainer(object):
 
         for k, v in self.modules.items():
             logger.warning(f"Saving {k} parameters ...")
-            data[k] = v.state_dict()
+            data[k] = getattr(v, "_orig_mod", v).state_dict()  # compiled modules
 
         if include_optimizer:
             logger.warning("Saving optimizer ...")
             data["optimizer"] = self.optimizer.state_dict()
-            if self.scaler is not None:
+            if self.scaler.is_enabled():
                 data["scaler"] = self.scaler.state_dict()
 
         torch.save(data, path)
@@ -278,8 +316,8 @@ class Trainer(object):
         # Save encoder and decoder state dicts
         encoder_path = os.path.join(save_dir, "encoder_mask.pth")
         decoder_path = os.path.join(save_dir, "decoder_mask.pth")
-        torch.save(self.modules["encoder"].state_dict(), encoder_path)
-        torch.save(self.modules["decoder"].state_dict(), decoder_path)
+        torch.save(getattr(self.modules["encoder"], "_orig_mod", self.modules["encoder"]).state_dict(), encoder_path)
+        torch.save(getattr(self.modules["decoder"], "_orig_mod", self.modules["decoder"]).state_dict(), decoder_path)
         
         # Save model configuration
         config = {
@@ -305,19 +343,10 @@ class Trainer(object):
         """
         Reload a checkpoint if we find one.
         """
-        checkpoint_path = os.path.join(self.params.dump_path, "checkpoint.pth")
-        if not os.path.isfile(checkpoint_path):
-            if self.params.reload_checkpoint == "":
-                return
-            else:
-                checkpoint_path = self.params.reload_checkpoint
-                assert os.path.isfile(checkpoint_path)
-        logger.warning(f"Reloading checkpoint from {checkpoint_path} ...")
-        data = torch.load(checkpoint_path, map_location="cpu")
-
-        # reload model parameters
-        for k, v in self.modules.items():
-            v.load_state_dict(data[k])
+        reloaded = reload_checkpoint_modules(self.modules, self.params, self.epoch_size)
+        if reloaded is None:
+            return
+        data, self.epoch = reloaded
 
         # reload optimizer
         # AMP checkpoint reloading is buggy, we cannot reload optimizer
@@ -325,14 +354,13 @@ class Trainer(object):
         logger.warning("Reloading checkpoint optimizer ...")
         self.optimizer.load_state_dict(data["optimizer"])
 
-        if self.params.fp16:
+        if self.scaler.is_enabled() and "scaler" in data:
             logger.warning("Reloading gradient scaler ...")
             self.scaler.load_state_dict(data["scaler"])
-        else:
-            assert self.scaler is None and "scaler" not in data
 
-        # reload main metrics
-        self.epoch = data["epoch"] + 1
+        # reload main metrics (checkpoints saved within an epoch resume that epoch)
+        if self.epoch == data["epoch"]:
+            self.n_equations = data["n_equations"]
         self.n_total_iter = data["n_total_iter"]
         self.best_metrics = data["best_metrics"]
         self.best_stopping_criterion = data["best_stopping_criterion"]
@@ -347,6 +375,22 @@ class Trainer(object):
         if self.params.save_periodic > 0 and self.epoch % self.params.save_periodic == 0:
             self.save_checkpoint("periodic-%i" % self.epoch)
 
+    def save_step(self):
+        """
+        Save a checkpoint every `save_every` iterations, to resume training within an epoch.
+        Once the epoch is complete, the checkpoint is saved by `end_epoch`, after the evaluation.
+        """
+        if self.n_equations >= self.epoch_size:
+            return
+        if self.params.save_every > 0 and self.n_total_iter % self.params.save_every == 0:
+            self.save_checkpoint("checkpoint")
+
+    def reached_max_steps(self):
+        """
+        Whether the maximum number of training iterations has been reached.
+        """
+        return self.params.max_steps >= 0 and self.n_total_iter >= self.params.max_steps
+
     def save_best_model(self, scores):
         """
         Save best models according to given validation metrics.
@@ -448,44 +492,74 @@ class Trainer(object):
         # cuda
         x1, len1, x2, len2, x3, len3, x4, len4 = to_cuda(x1, len1, x2, len2, x3, len3, x4, len4)
 
-        # TRAIN THE GENERATION OF LYAPUNOV FUNCTIONS
+        # forward / backward, gradients are only all-reduced on the last micro-batch of an accumulation window
+        self.accum_step += 1
+        with self.grad_sync_context():
+            # TRAIN THE GENERATION OF LYAPUNOV FUNCTIONS
 
-        # target words to predict
-        alen = torch.arange(len2.max(), dtype=torch.long, device=len2.device)
-        pred_mask = alen[:, None] < len2[None] - 1  # do not predict anything given the last target word
+            # target words to predict
+            alen = torch.arange(len2.max(), dtype=torch.long, device=len2.device)
+            pred_mask = alen[:, None] < len2[None] - 1  # do not predict anything given the last target word
 
-        y = x2[1:].masked_select(pred_mask[:-1])
+            y = x2[1:].masked_select(pred_mask[:-1])
 
-        assert len(y) == (len2 - 1).sum().item()
+            assert len(y) == (len2 - 1).sum().item()
 
-        # forward / loss
-        encoded = encoder("fwd", x=x1, lengths=len1, causal=False)
-        decoded = decoder("fwd", x=x2, lengths=len2, causal=True, src_enc=encoded.transpose(0, 1), src_len=len1)
-        _, loss_lyap = decoder("predict", tensor=decoded, pred_mask=pred_mask, y=y, get_scores=False)
+            # forward / loss
+            with torch.autocast(device_type="cuda", dtype=self.amp_dtype, enabled=self.amp_enabled):
+                encoded = encoder("fwd", x=x1, lengths=len1, causal=False)
+                decoded = decoder("fwd", x=x2, lengths=len2, causal=True, src_enc=encoded.transpose(0, 1), src_len=len1)
+                _, loss_lyap = decoder("predict", tensor=decoded, pred_mask=pred_mask, y=y, get_scores=False)
 
-        # TRAIN THE MASK FILLING OF VECTOR FIELDS
+            # TRAIN THE MASK FILLING OF VECTOR FIELDS
 
-        # target words to predict
-        alen = torch.arange(len4.max(), dtype=torch.long, device=len4.device)
-        pred_mask = alen[:, None] < len4[None] - 1  # do not predict anything given the last target word
+            # target words to predict
+            alen = torch.arange(len4.max(), dtype=torch.long, device=len4.device)
+            pred_mask = alen[:, None] < len4[None] - 1  # do not predict anything given the last target word
 
-        y2 = x4[1:].masked_select(pred_mask[:-1])
+            y2 = x4[1:].masked_select(pred_mask[:-1])
 
-        assert len(y2) == (len4 - 1).sum().item()
+            assert len(y2) == (len4 - 1).sum().item()
 
-        # forward / loss
-        encoded = encoder("fwd", x=x3, lengths=len3, causal=False)
-        decoded = decoder("fwd", x=x4, lengths=len4, causal=True, src_enc=encoded.transpose(0, 1), src_len=len3)
-        _, loss_mask = decoder("predict", tensor=decoded, pred_mask=pred_mask, y=y2, get_scores=False)
+            # forward / loss
+            with torch.autocast(device_type="cuda", dtype=self.amp_dtype, enabled=self.amp_enabled):
+                encoded = encoder("fwd", x=x3, lengths=len3, causal=False)
+                decoded = decoder("fwd", x=x4, lengths=len4, causal=True, src_enc=encoded.transpose(0, 1), src_len=len3)
+                _, loss_mask = decoder("predict", tensor=decoded, pred_mask=pred_mask, y=y2, get_scores=False)
 
-        loss = loss_lyap + loss_mask
+            loss = loss_lyap + loss_mask
 
-        self.stats[task].append(loss.item())
+            self.stats[task].append(loss.item())
 
-        # optimize
-        self.optimize(loss)
+            # optimize
+            self.optimize(loss)
 
         # number of processed sequences / words
         self.n_equations += params.batch_size
         self.stats["processed_e"] += len1.size(0)
         self.stats["processed_w"] += (len1 + len2 - 2).sum().item()
+
+
+class EvalOnlyTrainer(object):
+
+    EQUATIONS = {}
+
+    def __init__(self, modules, env, params):
+        """
+        Minimal trainer for `eval_only` runs: only exposes what the evaluator needs.
+        No optimizer and no training data loaders, checkpoints only reload the modules and the epoch.
+        """
+        assert params.eval_only
+        self.modules = modules
+        self.params = params
+        self.env = env
+        self.amp_dtype, self.amp_enabled = get_amp(params)
+
+        # reload potential checkpoints
+        self.epoch = 0
+        reloaded = reload_checkpoint_modules(modules, params, params.epoch_size)
+        if reloaded is not None:
+            self.epoch = reloaded[1]
+            logger.warning(f"Checkpoint reloaded. Evaluating at epoch {self.epoch} ...")
+
+        self.data_path = get_data_path(env, params)
@@ -8,6 +8,7 @@
 import os
 import re
 import sys
+import json
 import math
 import time
 import pickle
@@ -54,9 +55,11 @@ def initialize_exp(params):
     - dump parameters
     - create a logger
     """
-    # dump parameters
+    # dump parameters (pickle, and a JSON sidecar that is faster / safer to reload)
     get_dump_path(params)
     pickle.dump(params, open(os.path.join(params.dump_path, "params.pkl"), "wb"))
+    with open(os.path.join(params.dump_path, "params.json"), "w") as f:
+        json.dump(vars(params), f, default=str)
 
     # get running command
     command = ["python", sys.argv[0]]
@@ -125,10 +128,11 @@ def get_dump_path(params):
 def to_cuda(*args):
     """
     Move tensors to CUDA.
+    Copies are asynchronous when tensors are in pinned memory.
     """
     if not CUDA:
         return args
-    return [None if x is None else x.cuda() for x in args]
+    return [None if x is None else x.cuda(non_blocking=True) for x in args]
 
 
 class MyTimeoutError(BaseException):
@@ -5,9 +5,11 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import sys
 import json
 import random
 import argparse
+from functools import lru_cache
 import numpy as np
 import torch
 import os
@@ -18,13 +20,23 @@ from src.slurm import init_signal_handler, init_distributed_mode
 from src.utils import bool_flag, initialize_exp
 from src.model import check_model_params, build_modules
 from src.envs import ENVS, build_env
-from src.trainer import Trainer
+from src.trainer import Trainer, EvalOnlyTrainer
 from src.evaluator import Evaluator
 
 
-np.seterr(all="raise")
+def get_env_name(argv, default="ode"):
+    """
+    Read the environment name from the command line, without parsing all arguments.
+    """
+    for i, arg in enumerate(argv):
+        if arg == "--env_name" and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith("--env_name="):
+            return arg[len("--env_name=") :]
+    return default
 
 
+@lru_cache(maxsize=None)
 def get_parser():
     """
     Generate a parameters parser.
@@ -39,9 +51,12 @@ def get_parser():
     parser.add_argument("--exp_id", type=str, default="", help="Experiment ID")
 
     # float16 / AMP API
-    parser.add_argument("--fp16", type=bool_flag, default=True, help="Run model with float16")
     parser.add_argument(
-        "--amp", type=int, default=2, help="Use AMP wrapper for float16 / distributed / gradient accumulation. Level of optimization. -1 to disable."
+        "--amp",
+        type=str,
+        default="auto",
+        choices=["auto", "off", "fp16", "bf16"],
+        help="Mixed precision autocast dtype (auto: bf16 on Ampere+ GPUs, fp16 on older ones). fp16 uses a gradient scaler. off to disable.",
     )
 
     # model parameters
@@ -67,6 +82,10 @@ def get_parser():
     parser.add_argument("--clip_grad_norm", type=float, default=5, help="Clip gradients norm (0 to disable)")
     parser.add_argument("--epoch_size", type=int, default=300000, help="Epoch size / evaluation frequency")
     parser.add_argument("--max_epoch", type=int, default=100000, help="Maximum epoch size")
+    parser.add_argument("--max_steps", type=int, default=-1, help="Maximum number of training iterations (-1 for no limit)")
+    parser.add_argument(
+        "--save_every", type=int, default=0, help="Save a checkpoint every N iterations, to resume training within an epoch (0 to disable)"
+    )
     parser.add_argument(
         "--stopping_criterion", type=str, default="", help="Stopping criterion, and number of non-increase before stopping the experiment"
     )
@@ -88,7 +107,7 @@ def get_parser():
 
     # environment parameters
     parser.add_argument("--env_name", type=str, default="ode", help="Environment name")
-    ENVS[parser.parse_known_args()[0].env_name].register_args(parser)
+    ENVS[get_env_name(sys.argv[1:])].register_args(parser)
 
     # tasks
     parser.add_argument("--tasks", type=str, default="ode_lyapunov", help="Tasks")
@@ -126,6 +145,14 @@ def get_parser():
 
     # CPU / multi-gpu / multi-node
     parser.add_argument("--cpu", type=bool_flag, default=False, help="Run on CPU")
+    parser.add_argument("--compile", type=bool_flag, default=False, help="Compile the modules with torch.compile (GPU only)")
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        default="default",
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="torch.compile mode, requires --compile true. reduce-overhead replays CUDA graphs (one recorded per sequence length)",
+    )
     parser.add_argument("--local_rank", type=int, default=-1, help="Multi-GPU - Local rank")
     parser.add_argument("--master_port", type=int, default=-1, help="Master port (for multi-node SLURM jobs)")
 
@@ -138,7 +165,8 @@ def main(params):
     # initialize experiment / SLURM signal handler for time limit / pre-emption
     init_distributed_mode(params)
     logger = initialize_exp(params)
-    init_signal_handler()
+    if not params.eval_only:
+        init_signal_handler()
 
     # CPU / CUDA
     if params.cpu:
@@ -147,39 +175,86 @@ def main(params):
         assert torch.cuda.is_available()
     src.utils.CUDA = not params.cpu
 
+    # mixed precision: bfloat16 has the float32 range and does not require loss scaling
+    if params.amp == "auto":
+        if params.cpu:
+            params.amp = "off"
+        else:
+            params.amp = "bf16" if torch.cuda.get_device_capability()[0] >= 8 else "fp16"
+    logger.info("Mixed precision: %s", params.amp)
+
+    # TF32 matmuls / convolutions (Ampere+) and cuDNN autotuner
+    if not params.cpu:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+
     # build environment / modules / trainer / evaluator
     env = build_env(params)
     modules = build_modules(env, params)
-    trainer = Trainer(modules, env, params)
+    if params.compile and not params.cpu:
+        # sequences are padded to the longest one in the batch, so shapes vary from one batch to the next
+        for k, v in modules.items():
+            modules[k] = torch.compile(v, mode=params.compile_mode, dynamic=True)
+    trainer = EvalOnlyTrainer(modules, env, params) if params.eval_only else Trainer(modules, env, params)
     evaluator = Evaluator(trainer)
 
     # evaluation
     if params.eval_only:
         scores = evaluator.run_all_evals()
         for k, v in scores.items():
-            logger.info("%s -> %.6f" % (k, v))
-        logger.info("__log__:%s" % json.dumps(scores))
+            logger.info("%s -> %.6f", k, v)
+        logger.info("__log__:%s", json.dumps(scores))
         exit()
 
+    # task order RNG, seeded from the master so that all workers iterate over tasks in the same order
+    task_seed = torch.LongTensor([np.random.randint(1_000_000_000)])
+    if params.multi_gpu:
+        task_seed = task_seed.cuda()
+        torch.distributed.broadcast(task_seed, src=0)
+    task_rng = np.random.RandomState(task_seed.item())
+
     # training
+    n_tasks = len(params.tasks)
     for _ in range(params.max_epoch):
 
-        logger.info("============ Starting epoch %i ... ============" % trainer.epoch)
+        if params.is_master:
+            logger.info("============ Starting epoch %i ... ============", trainer.epoch)
 
-        trainer.n_equations = 0
+        # task schedule of the epoch (one random permutation of the tasks per round, drawn at once)
+        n_rounds = -(-trainer.epoch_size // params.batch_size)
+        if n_tasks == 1:
+            schedule = np.zeros((n_rounds, 1), dtype=np.int64)
+        else:
+            schedule = task_rng.rand(n_rounds, n_tasks).argsort(axis=1)
+        round_id = 0
 
-        while trainer.n_equations < trainer.epoch_size:
+        while trainer.n_equations < trainer.epoch_size and not trainer.reached_max_steps():
 
             # training steps
-            for task_id in np.random.permutation(len(params.tasks)):
+            for task_id in schedule[round_id]:
                 task = params.tasks[task_id]
                 if params.export_data:
                     trainer.export_data(task)
+                    trainer.iter()
                 else:
                     trainer.enc_dec_step(task)
-                trainer.iter()
+                    # one iteration per optimizer update (accumulation window)
+                    if trainer.accum_step % params.accumulate_gradients == 0:
+                        trainer.iter()
+                        trainer.save_step()
+            round_id += 1
+
+        # max_steps reached within the epoch: save a checkpoint resuming this epoch, without evaluating it
+        if trainer.n_equations < trainer.epoch_size:
+            trainer.save_checkpoint("checkpoint")
+            if params.is_master:
+                logger.info("============ Reached %i steps within epoch %i, stopping ============", trainer.n_total_iter, trainer.epoch)
+            break
 
-        logger.info("============ End of epoch %i ============" % trainer.epoch)
+        if params.is_master:
+            logger.info("============ End of epoch %i ============", trainer.epoch)
 
         # evaluate perplexity
         if params.is_master:
@@ -188,14 +263,21 @@ def main(params):
 
             # print / JSON log
             for k, v in scores.items():
-                logger.info("%s -> %.6f" % (k, v))
-            logger.info("__log__:%s" % json.dumps(scores))
+                logger.info("%s -> %.6f", k, v)
+            logger.info("__log__:%s", json.dumps(scores))
 
             # end of epoch
             trainer.save_best_model(scores)
             trainer.save_periodic()
             trainer.end_epoch(scores)
 
+        # wait for the master to finish evaluating / saving before starting the next epoch
+        if params.multi_gpu:
+            torch.distributed.barrier()
+        if trainer.reached_max_steps():
+            break
+        trainer.n_equations = 0
+
 
 if __name__ == "__main__":
 
@@ -204,16 +286,22 @@ if __name__ == "__main__":
     params = parser.parse_args()
 
     if params.eval_only and params.eval_from_exp != "":
-        # read params from pickle
+        # read params from JSON (or from pickle for older experiments)
+        json_file = params.eval_from_exp + "/params.json"
         pickle_file = params.eval_from_exp + "/params.pkl"
         exp_str = params.eval_from_exp
-        assert os.path.isfile(pickle_file)
-        pk = pickle.load(open(pickle_file, "rb"))
-        pickled_args = pk.__dict__
-        del pickled_args["exp_id"]
-        del pickled_args["dump_path"]
-        del pickled_args["exp_name"]
-        for key in [
+        if os.path.isfile(json_file):
+            with open(json_file, "r") as f:
+                loaded = json.load(f)
+        else:
+            assert os.path.isfile(pickle_file)
+            loaded = pickle.load(open(pickle_file, "rb")).__dict__
+
+        # parameters of the current run that are not overridden by the experiment ones
+        blocked = {
+            "exp_id",
+            "dump_path",
+            "exp_name",
             "eval_data",
             "batch_size_eval",
             "local_rank",
@@ -225,13 +313,9 @@ if __name__ == "__main__":
             "max_len",
             "max_output_len",
             "lyap_SOS_checker",
-        ]:
-            if key in pickled_args:
-                del pickled_args[key]
-
-        for p in params.__dict__:
-            if p in pickled_args:
-                params.__dict__[p] = pickled_args[p]
+            "amp",
+        }
+        params.__dict__.update({k: v for k, v in loaded.items() if k in params.__dict__ and k not in blocked})
 
         params.eval_only = True
         params.reload_model = exp_str + "/best-" + params.validation_metrics + ".pth"